@@ -11,17 +11,16 @@ from flask import Flask
 import os
 #import psycopg2
 import datetime
+import time
 import sqlite3
 
 import re
 import nltk
 #nltk.download('punkt')
 #nltk.download('stopwords')
-from nltk.probability import FreqDist
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
 from textblob import TextBlob
 import config as c
+import windowCache as wc
 
 from io import BytesIO
 
@@ -48,6 +47,14 @@ app.title = 'Real-Time Twitter Analysis'
 
 server = app.server
 
+# Shared by both callbacks so each refresh only loads the tweets stored since the last one
+window = wc.WindowCache()
+
+# The app may start on a database the streamer has not migrated yet
+conn = sqlite3.connect(c.DATABASE_NAME)
+c.create_table(conn)
+conn.close()
+
 
 app.layout = html.Div(children=[
     html.H2('Real-time Twitter Analysis', style={
@@ -133,9 +140,7 @@ def update_graph_live(n):
 
     # Loading data from Heroku PostgreSQL
     conn = sqlite3.connect(c.DATABASE_NAME)
-    timenow = (datetime.datetime.utcnow() - datetime.timedelta(hours=0, minutes=30)).strftime('%Y-%m-%d %H:%M:%S')
-    query = "SELECT id_str, text, created_at, polarity,user_location FROM {} WHERE created_at >= '{}'".format(c.TABLE_NAME, timenow)
-    df = pd.read_sql(query, con=conn)
+    window.refresh(conn)
 
     dailytime = (datetime.datetime.now() - datetime.timedelta(days = 1,hours=0, minutes=0)).strftime('%Y-%m-%d')
     dailytime = dailytime+' 18:30:00'
@@ -147,24 +152,15 @@ def update_graph_live(n):
 
     conn.close()
 
-    # Convert UTC into PDT
-
-    df['polarity'] = df['polarity'].apply(c.polarity_change)
-    df['created_at'] = df['created_at'].apply(c.dateconversion)
-    df['created_at'] = pd.to_datetime(df['created_at'])
-    df['created_at'] = df['created_at'].apply(lambda x:x.tz_localize(None))
-
-    # Clean and transform data to enable time series
-    result = df.groupby([pd.Grouper(key='created_at', freq='10s'), 'polarity']).count().unstack(fill_value=0).stack().reset_index()
-    result = result.rename(columns={"id_str": "Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0]), "created_at":"Time"})
-    time_series = result["Time"][result['polarity']==0].reset_index(drop=True)
+    # Sentiment counts per 10 seconds, scaled up for tweets the streamer sampled out
+    buckets, counts = window.sentiment_series(10)
+    # Convert UTC into local time
+    time_series = [datetime.datetime.fromtimestamp(t) for t in buckets]
 
-    min10 = datetime.datetime.now() - datetime.timedelta(hours=0, minutes=10)
-    min20 = datetime.datetime.now() - datetime.timedelta(hours=0, minutes=20)
+    min10 = time.time() - 10*60
+    min20 = time.time() - 20*60
 
-    neu_num = result[result['Time']>min10]["Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0])][result['polarity']==0].sum()
-    neg_num = result[result['Time']>min10]["Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0])][result['polarity']==-1].sum()
-    pos_num = result[result['Time']>min10]["Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0])][result['polarity']==1].sum()
+    neg_num, neu_num, pos_num = counts[buckets > min10].sum(axis=0).astype(int)
 
 
 
@@ -172,8 +168,8 @@ def update_graph_live(n):
     daily_tweets_num = dailycount['count(*)'][0]
     # Percentage Number of Tweets changed in Last 10 mins
 
-    count_now = df[df['created_at'] > min10]['id_str'].count()
-    count_before = df[ (min20 < df['created_at']) & (df['created_at'] < min10)]['id_str'].count()
+    count_now = window.count_since(min10)
+    count_before = window.count_since(min20) - count_now
     percent = (count_now-count_before)/count_before*100
     # Create the graph
     children = [
@@ -265,7 +261,7 @@ def update_graph_live(n):
                                 'data': [
                                     go.Scatter(
                                         x=time_series,
-                                        y=result["Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0])][result['polarity']==0].reset_index(drop=True),
+                                        y=counts[:, 1],
                                         name="Neutrals",
                                         opacity=0.8,
                                         mode='lines',
@@ -274,7 +270,7 @@ def update_graph_live(n):
                                     ),
                                     go.Scatter(
                                         x=time_series,
-                                        y=result["Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0])][result['polarity']==-1].reset_index(drop=True).apply(lambda x: -x),
+                                        y=-counts[:, 0],
                                         name="Negatives",
                                         opacity=0.8,
                                         mode='lines',
@@ -283,7 +279,7 @@ def update_graph_live(n):
                                     ),
                                     go.Scatter(
                                         x=time_series,
-                                        y=result["Num of '{}' mentions".format(c.TRACK_WORDS_KEY[0])][result['polarity']==1].reset_index(drop=True),
+                                        y=counts[:, 2],
                                         name="Positives",
                                         opacity=1,
                                         mode='lines',
@@ -337,65 +333,19 @@ def update_graph_bottom_live(n):
 
     # Loading data from Heroku PostgreSQL
     conn = sqlite3.connect(c.DATABASE_NAME)
-    mycursor = conn.cursor()
-    timenow = (datetime.datetime.utcnow() - datetime.timedelta(hours=0, minutes=30)).strftime('%Y-%m-%d %H:%M:%S')
-    query = "SELECT id_str, text, created_at, polarity,user_location FROM {} WHERE created_at >= '{}'".format(c.TABLE_NAME, timenow)
-    df = pd.read_sql(query, con=conn)
+    window.refresh(conn)
     conn.close()
 
-
-
-    # Convert UTC into PDT
-    df['created_at'] = df['created_at'].apply(c.dateconversion)
-    df['created_at'] = pd.to_datetime(df['created_at'])
-    df['created_at'] = df['created_at'].apply(lambda x:x.tz_localize(None))
-
-
-    # Clean and transform data to enable word frequency
-    content = ' '.join(df["text"])
-    content = re.sub(r"http\S+", "", content)
-    content = content.replace('RT ', ' ').replace('&amp;', 'and')
-    hashtags = c.hastag(content)
-    content = re.sub('[^A-Za-z0-9]+', ' ', content)
-    content = content.lower()
-
-    # Filter constants for states in US
-    #STATES,STATE_DICT,INV_STATE_DICT = c.STATES,c.STATE_DICT,c.INV_STATE_DICT
-    STATES,STATE_DICT,INV_STATE_DICT = pickle.load(open('countries.p','rb'))
-    # Clean and transform data to enable geo-distribution
-    is_in_US=[]
-    geo = df[['user_location']]
-    df = df.fillna(" ")
-    for x in df['user_location']:
-        check = False
-        for s in STATES:
-            if s in x:
-                is_in_US.append(STATE_DICT[s] if s in STATE_DICT else s)
-                check = True
-                break
-        if not check:
-            is_in_US.append(None)
-
-    geo_dist = pd.DataFrame(is_in_US, columns=['State']).dropna().reset_index()
-    geo_dist = geo_dist.groupby('State').count().rename(columns={"index": "Number"}) \
-        .sort_values(by=['Number'], ascending=False).reset_index()
+    # Countries resolved from user locations
+    geo_dist = pd.DataFrame(window.country_counts(), columns=['State', 'Number'])
     geo_dist["Log Num"] = geo_dist["Number"].apply(lambda x: math.log(x, 2))
 
 
-    geo_dist['Full State Name'] = geo_dist['State'].apply(lambda x: INV_STATE_DICT[x])
+    geo_dist['Full State Name'] = geo_dist['State'].apply(lambda x: c.INV_STATE_DICT[x])
     geo_dist['text'] = geo_dist['Full State Name'] + '<br>' + 'Num: ' + geo_dist['Number'].astype(str)
 
 
-    tokenized_word = word_tokenize(content)
-    stop_words=set(stopwords.words("english"))
-    #stop_words=[]
-    filtered_sent=[]
-    for w in tokenized_word:
-        if (w not in stop_words) and (len(w) >= 3):
-            filtered_sent.append(w)
-
-    fdist = FreqDist(hashtags)
-    fd = pd.DataFrame(fdist.most_common(10), columns = ["Word","Frequency"]).drop([0]).reindex()
+    fd = pd.DataFrame(window.top_tokens(10, hashtags=True), columns = ["Word","Frequency"]).drop([0]).reindex()
     #fd['Polarity'] = fd['Word'].apply(lambda x: TextBlob(x).sentiment.polarity)
     #fd['Marker_Color'] = fd['Polarity'].apply(lambda x: 'rgba(255, 50, 50, 0.6)' if x < -0.1 else \
     #    ('rgba(51, 255, 255, 0.6)' if x > 0.1 else 'rgba(131, 90, 241, 0.6)'))
@@ -406,7 +356,7 @@ def update_graph_bottom_live(n):
     #print(fd['Word'].loc[::-1].tolist())
     #print(geo_dist)
 
-    word_cloud_words = c.datakeyValue(filtered_sent)
+    word_cloud_words = dict(window.top_tokens(2000))
     img = BytesIO()
     plot_wordcloud(data=word_cloud_words).save(img, format='PNG')
 
@@ -0,0 +1,144 @@
+'''
+Recompute the stored TextBlob polarity/subjectivity, gazetteer country and word tokens of past tweets,
+e.g. after upgrading TextBlob or changing the stopwords or countries.p. Sentiment thresholds
+(config.NEGATIVE_THRESHOLD/POSITIVE_THRESHOLD) are applied when tweets are read and need no backfill.
+
+The dashboard reloads its half-hour window whenever a chunk is checkpointed, so recomputed tweets
+still inside the window show up at the next refresh.
+
+    python backfill.py --workers 4 --since "2020-03-01 00:00:00" --until "2020-04-01 00:00:00"
+'''
+import argparse
+import sqlite3
+import time
+from multiprocessing import Pool
+from textblob import TextBlob
+import config as c
+
+
+CHECKPOINT_TABLE = c.BACKFILL_TABLE
+# Stored country_code of a tweet whose location matched nothing, NULL means not backfilled yet
+NO_COUNTRY_CODE = ''
+CHECKPOINT_ATTRIBUTES = "run VARCHAR(255), start_rowid INT, end_rowid INT, since DATETIME, until DATETIME, rows INT, finished_at DATETIME"
+
+
+def time_filter(since, until):
+    '''
+    SQL predicates and parameters restricting created_at to [since, until), either bound may be None
+    '''
+    predicates = []
+    params = []
+    if since is not None:
+        predicates.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        predicates.append("created_at < ?")
+        params.append(until)
+    return ''.join(" AND " + p for p in predicates), params
+
+
+def recompute_chunk(bounds):
+    '''
+    Re-run sentiment, geo resolution and tokenization for the tweets with rowid in [start, end)
+    '''
+    start, end, since, until = bounds
+    # Read-only connection, the parent process does all the writing
+    conn = sqlite3.connect('file:{}?mode=ro'.format(c.DATABASE_NAME), uri=True, timeout=30)
+    predicates, params = time_filter(since, until)
+    query = "SELECT rowid, text, polarity, user_location FROM {} WHERE rowid >= ? AND rowid < ?{}".format(c.TABLE_NAME, predicates)
+    rows = conn.execute(query, [start, end] + params).fetchall()
+    conn.close()
+
+    results = []
+    for rowid, text, polarity, user_location in rows:
+        text = text or ''
+        subjectivity = None
+        # Tweets the streamer sampled out stay unscored so their sample_rate weights remain valid
+        if polarity is not None:
+            sentiment = TextBlob(text).sentiment
+            polarity = sentiment.polarity
+            subjectivity = sentiment.subjectivity
+        country_code = c.country_code(user_location) or NO_COUNTRY_CODE
+        results.append((polarity, subjectivity, country_code, ' '.join(c.tokenize(text)), rowid))
+    return start, end, results
+
+def prepare(conn):
+    '''
+    Switch to WAL so readers never block the streamer, and add the derived columns and checkpoint table
+    '''
+    c.create_table(conn)
+    mycursor = conn.cursor()
+    mycursor.execute("PRAGMA journal_mode=WAL")
+    mycursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(CHECKPOINT_TABLE, CHECKPOINT_ATTRIBUTES))
+    conn.commit()
+    mycursor.close()
+
+def pending_chunks(conn, run, chunk_size, since, until):
+    '''
+    rowid ranges covering the tweets created in [since, until) not yet checkpointed for this run
+    '''
+    widths = conn.execute("SELECT DISTINCT end_rowid - start_rowid FROM {} WHERE run = ?".format(CHECKPOINT_TABLE), (run,)).fetchall()
+    if any(width != chunk_size for (width,) in widths):
+        raise SystemExit("Run '{}' was checkpointed with a different chunk size, resume it with the same --chunk-size or use --restart".format(run))
+    bounds = conn.execute("SELECT DISTINCT since, until FROM {} WHERE run = ?".format(CHECKPOINT_TABLE), (run,)).fetchall()
+    if any(bound != (since, until) for bound in bounds):
+        raise SystemExit("Run '{}' was checkpointed with different --since/--until, resume it with the same bounds or use --restart".format(run))
+    done = set(row[0] for row in conn.execute("SELECT start_rowid FROM {} WHERE run = ?".format(CHECKPOINT_TABLE), (run,)))
+
+    # Only chunk the rowids the time bounds cover, so a narrow slice does not checkpoint empty chunks
+    predicates, params = time_filter(since, until)
+    min_rowid, max_rowid = conn.execute("SELECT min(rowid), max(rowid) FROM {} WHERE 1{}".format(c.TABLE_NAME, predicates), params).fetchone()
+    if min_rowid is None:
+        return []
+    first = min_rowid - min_rowid % chunk_size
+    return [(start, start + chunk_size) for start in range(first, max_rowid + 1, chunk_size) if start not in done]
+
+def write_chunk(conn, run, start, end, since, until, results, batch_size):
+    '''
+    Write a chunk's results back in short transactions, checkpointing it together with its last batch
+    '''
+    sql = "UPDATE {} SET polarity = ?, subjectivity = ?, country_code = ?, tokens = ? WHERE rowid = ?".format(c.TABLE_NAME)
+    mycursor = conn.cursor()
+    for i in range(0, len(results), batch_size):
+        mycursor.executemany(sql, results[i:i + batch_size])
+        if i + batch_size < len(results):
+            conn.commit()
+    mycursor.execute("INSERT INTO {} (run, start_rowid, end_rowid, since, until, rows, finished_at) VALUES (?, ?, ?, ?, ?, ?, datetime('now'))".format(CHECKPOINT_TABLE),
+                     (run, start, end, since, until, len(results)))
+    conn.commit()
+    mycursor.close()
+
+def backfill(run, chunk_size, batch_size, workers, since, until, restart):
+    conn = sqlite3.connect(c.DATABASE_NAME, timeout=30)
+    prepare(conn)
+    if restart:
+        conn.execute("DELETE FROM {} WHERE run = ?".format(CHECKPOINT_TABLE), (run,))
+        conn.commit()
+    chunks = pending_chunks(conn, run, chunk_size, since, until)
+    print("Run '{}': {} chunks of {} rows to process".format(run, len(chunks), chunk_size))
+
+    started = time.time()
+    total = 0
+    with Pool(workers) as pool:
+        tasks = [(start, end, since, until) for start, end in chunks]
+        for done, (start, end, results) in enumerate(pool.imap_unordered(recompute_chunk, tasks), 1):
+            write_chunk(conn, run, start, end, since, until, results, batch_size)
+            total += len(results)
+            elapsed = time.time() - started
+            print("Chunk {}-{}: {} rows | {}/{} chunks, {} rows, {:.0f} rows/s".format(
+                start, end - 1, len(results), done, len(chunks), total, total / elapsed if elapsed else 0))
+    conn.close()
+    print("Backfill '{}' finished: {} rows in {:.0f}s".format(run, total, time.time() - started))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute sentiment, countries and tokens for stored tweets')
+    parser.add_argument('--run', default='default', help='checkpoint name, rerun with the same name to resume')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='rowids per chunk handed to a worker')
+    parser.add_argument('--batch-size', type=int, default=500, help='rows written per transaction')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the number of CPUs')
+    parser.add_argument('--since', default=None, help='only tweets created at or after this UTC time, e.g. "2020-03-10 00:00:00"')
+    parser.add_argument('--until', default=None, help='only tweets created before this UTC time')
+    parser.add_argument('--restart', action='store_true', help='discard the checkpoints of this run first')
+    args = parser.parse_args()
+    backfill(args.run, args.chunk_size, args.batch_size, args.workers, args.since, args.until, args.restart)
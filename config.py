@@ -1,24 +1,70 @@
 from datetime import datetime, timezone
-from dateutil import tz
-import datetime
 import pickle
-from nltk.probability import FreqDist
+import sqlite3
+import numpy as np
+from nltk.tokenize import word_tokenize
+from nltk.corpus import stopwords
 import re
 
 
 DATABASE_NAME = 'Twitterdata.db'
 TABLE_NAME = "Tweets"
+TABLE_ATTRIBUTES = "id_str VARCHAR(255), created_at DATETIME, text VARCHAR(255), \
+            polarity INT, subjectivity INT, user_created_at VARCHAR(255), user_location VARCHAR(255), \
+            user_description VARCHAR(255), user_followers_count INT, longitude DOUBLE, latitude DOUBLE, \
+            retweet_count INT, favorite_count INT, sample_rate DOUBLE, country_code VARCHAR(3), tokens VARCHAR(255)"
+# Checkpoints of backfill.py, also watched by the dashboard to reload recomputed tweets
+BACKFILL_TABLE = "Backfill"
+# Columns added after the first release, with their types, for migrating older databases
+ADDED_ATTRIBUTES = [("sample_rate", "DOUBLE"), ("country_code", "VARCHAR(3)"), ("tokens", "VARCHAR(255)")]
 STATES,STATE_DICT,INV_STATE_DICT = pickle.load(open('countries.p','rb'))
 TRACK_WORDS_KEY=["COVID19"]
+STOP_WORDS = set(stopwords.words("english"))
+# Polarity below NEGATIVE_THRESHOLD counts as negative, above POSITIVE_THRESHOLD as positive, neutral otherwise
+NEGATIVE_THRESHOLD = 0
+POSITIVE_THRESHOLD = 0
 
-def datakeyValue(words):
-    fdist = FreqDist(words)
-    d_k_v = {a: x for a, x in fdist.most_common(2000)}
-    return d_k_v
+def create_table(conn):
+    '''
+    Create the tweets table, or add the columns an older database is missing
+    '''
+    mycursor = conn.cursor()
+    mycursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(TABLE_NAME,TABLE_ATTRIBUTES))
+    columns = [row[1] for row in mycursor.execute("PRAGMA table_info({})".format(TABLE_NAME))]
+    for name, attribute in ADDED_ATTRIBUTES:
+        if name not in columns:
+            try:
+                mycursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(TABLE_NAME, name, attribute))
+            except sqlite3.OperationalError as e:
+                # Another process (a second app worker, the streamer) added it first
+                if 'duplicate column' not in str(e):
+                    raise
+    conn.commit()
+    mycursor.close()
 
 def hastag(text):
     return re.findall(r'\B#\w*[a-zA-Z]+\w*', text)
 
+def tokenize(text):
+    '''
+    Lower-cased words of a tweet without links, stopwords and words shorter than 3 letters
+    '''
+    content = re.sub(r"http\S+", "", text)
+    content = content.replace('RT ', ' ').replace('&amp;', 'and')
+    content = re.sub('[^A-Za-z0-9]+', ' ', content).lower()
+    return [w for w in word_tokenize(content) if (w not in STOP_WORDS) and (len(w) >= 3)]
+
+def country_code(location):
+    '''
+    Resolve a free-text user location to an ISO-3 country code, None if no city or country matches
+    '''
+    if not location:
+        return None
+    for s in STATES:
+        if s in location:
+            return STATE_DICT[s] if s in STATE_DICT else s
+    return None
+
 def clean_tweet(self, tweet):
     '''
     Use sumple regex statemnents to clean tweet text by removing links and special characters
@@ -41,18 +87,8 @@ def aslocaltimestr(utc_dt):
     return utc_to_local(utc_dt).strftime('%Y-%m-%d %H:%M:%S')
 
 def polarity_change(polarity):
-    if polarity<0:
-        polarity = -1
-    elif polarity>0:
-        polarity = 1
-    else:
-        polarity = 0
-    return polarity
-
-def dateconversion(text):
-    from_zone = tz.tzutc()
-    to_zone = tz.tzlocal()
-    utc = datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S')
-    utc = utc.replace(tzinfo=from_zone)
-    central = utc.astimezone(to_zone)
-    return central
+    '''
+    Map an array of TextBlob polarities to -1, 0 or 1 using the sentiment thresholds
+    '''
+    polarity = np.asarray(polarity)
+    return np.select([polarity < NEGATIVE_THRESHOLD, polarity > POSITIVE_THRESHOLD], [-1, 1], 0)
@@ -11,21 +11,37 @@ import time
 import math
 import datetime
 import re
+import queue
+import random
+import threading
+import config as c
 
 
 TRACK_WORDS=["Corona Virus","Corona","COVID19","Covid-19"]
-DATABASE_NAME = 'Twitterdata.db'
-TABLE_NAME = "Tweets"
-TABLE_ATTRIBUTES = "id_str VARCHAR(255), created_at DATETIME, text VARCHAR(255), \
-            polarity INT, subjectivity INT, user_created_at VARCHAR(255), user_location VARCHAR(255), \
-            user_description VARCHAR(255), user_followers_count INT, longitude DOUBLE, latitude DOUBLE, \
-            retweet_count INT, favorite_count INT"
 
-conn = sqlite3.connect(DATABASE_NAME)
-mycursor = conn.cursor()
-mycursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(TABLE_NAME,TABLE_ATTRIBUTES))
-conn.commit()
-mycursor.close()
+# Adaptive ingest: tweets are buffered between the stream and the database
+# writer. Once the buffer backs up or tweets arrive late, only a sampled
+# fraction gets sentiment; the rate is stored with every row so the
+# dashboard can scale its sentiment counts back to estimates.
+QUEUE_MAX_SIZE = 20000
+QUEUE_DEPTH_THRESHOLD = 500
+LAG_THRESHOLD_SECONDS = 30
+MIN_SAMPLE_RATE = 0.05
+COMMIT_BATCH_SIZE = 100
+# A batch that cannot be written is retried with backoff, then discarded
+WRITE_RETRY_LIMIT = 5
+WRITE_RETRY_INITIAL_SECONDS = 1
+WRITE_RETRY_MAX_SECONDS = 30
+STATS_INTERVAL_SECONDS = 60
+
+# Reconnect backoff, doubled on every failed attempt
+BACKOFF_INITIAL_SECONDS = 1
+BACKOFF_MAX_SECONDS = 320
+RATE_LIMIT_BACKOFF_SECONDS = 60
+
+conn = sqlite3.connect(c.DATABASE_NAME)
+c.create_table(conn)
+conn.close()
 
 
 def clean_tweet(self, tweet):
@@ -66,24 +82,155 @@ def dateconversion(text):
     central = utc.astimezone(to_zone)
     return central
 
+def sample_rate_for(depth, lag):
+    '''
+    Fraction of tweets to fully analyse given the writer's queue depth and processing lag (seconds)
+    '''
+    rate = 1.0
+    if depth > QUEUE_DEPTH_THRESHOLD:
+        rate = min(rate, QUEUE_DEPTH_THRESHOLD / depth)
+    if lag > LAG_THRESHOLD_SECONDS:
+        rate = min(rate, LAG_THRESHOLD_SECONDS / lag)
+    return max(rate, MIN_SAMPLE_RATE)
+
 class MyStreamListener(tweepy.StreamListener):
     '''
     Tweets are known as “status updates”. So the Status class in tweepy has properties describing the tweet.
     https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/tweet-object.html
     '''
 
+    def __init__(self, writer, api=None):
+        super(MyStreamListener, self).__init__(api)
+        self.writer = writer
+        self.connected = False
+        self.status_code = None
+
+    def on_connect(self):
+        self.connected = True
+
     def on_status(self, status):
         '''
-        Extract info from tweets
+        Hand tweets over to the writer thread so the stream is never blocked on processing
         '''
         if status.retweeted:
             # Avoid retweeted info, and only original tweets will be received
             return True
+        if not self.writer.is_alive():
+            # Disconnect so the main loop restarts the writer before the queue fills up
+            print("Tweet writer is not running, disconnecting")
+            return False
+        try:
+            self.writer.tweet_queue.put_nowait(status)
+        except queue.Full:
+            # Last resort when even sampling cannot keep up
+            self.writer.dropped += 1
+        return True
+
+    def on_error(self, status_code):
+        '''
+        Since Twitter API has rate limits, stop srcraping data as it exceed to the thresold.
+        '''
+        self.status_code = status_code
+        if status_code == 420:
+            # return False to disconnect the stream
+            return False
+
+
+class TweetWriter(threading.Thread):
+    '''
+    Drain the tweet queue into SQLite, sampling the expensive sentiment analysis under backpressure
+    '''
+
+    def __init__(self, tweet_queue):
+        super(TweetWriter, self).__init__(daemon=True)
+        self.tweet_queue = tweet_queue
+        self.sample_rate = 1.0
+        self.lag = 0.0
+        self.written = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.failed = 0
+        # Rows extracted but not yet written, at most COMMIT_BATCH_SIZE
+        self.batch = []
+        self.write_attempts = 0
+        self.retry_at = 0
+
+    def run(self):
+        try:
+            self.drain()
+        except Exception as e:
+            print("Tweet writer stopped: {}".format(e))
+            raise
+
+    def drain(self):
+        # sqlite connections cannot be shared across threads, so the writer owns its own
+        # Wait out the short write transactions of a running backfill instead of failing
+        conn = sqlite3.connect(c.DATABASE_NAME, timeout=30)
+        last_stats = time.time()
+        while True:
+            if len(self.batch) >= COMMIT_BATCH_SIZE and time.time() < self.retry_at:
+                # Stop draining while a full batch waits for its retry, so the queue backs up and sampling kicks in
+                time.sleep(min(self.retry_at - time.time(), 1))
+                status = None
+            else:
+                try:
+                    status = self.tweet_queue.get(timeout=1)
+                except queue.Empty:
+                    status = None
+            if status is not None:
+                try:
+                    self.batch.append(self.extract(status))
+                except Exception as e:
+                    self.failed += 1
+                    print("Failed to extract tweet {}: {}".format(getattr(status, 'id_str', None), e))
+            if self.batch and (len(self.batch) >= COMMIT_BATCH_SIZE or self.tweet_queue.empty()) and time.time() >= self.retry_at:
+                self.write(conn)
+            if time.time() - last_stats >= STATS_INTERVAL_SECONDS:
+                self.report()
+                last_stats = time.time()
+
+    def write(self, conn):
+        '''
+        Insert the pending batch in one transaction, keeping it for a later retry if the database is busy
+        '''
+        batch = self.batch
+        sql = "INSERT INTO {} (id_str, created_at, text, polarity, subjectivity, user_created_at, user_location, user_description, user_followers_count, longitude, latitude, retweet_count, favorite_count, sample_rate) VALUES (?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?, ?, ?, ?)".format(c.TABLE_NAME)
+        try:
+            conn.executemany(sql, batch)
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # Typically "database is locked", but a read-only or full database fails the same way for good
+            conn.rollback()
+            self.write_attempts += 1
+            if self.write_attempts < WRITE_RETRY_LIMIT:
+                delay = min(WRITE_RETRY_INITIAL_SECONDS * 2 ** (self.write_attempts - 1), WRITE_RETRY_MAX_SECONDS)
+                self.retry_at = time.time() + delay
+                print("Failed to write {} tweets, retrying in {} seconds: {}".format(len(batch), delay, e))
+                return
+            self.failed += len(batch)
+            print("Failed to write {} tweets after {} attempts, discarding them: {}".format(len(batch), self.write_attempts, e))
+        except Exception as e:
+            conn.rollback()
+            self.failed += len(batch)
+            print("Failed to write {} tweets, discarding them: {}".format(len(batch), e))
+        else:
+            self.written += len(batch)
+        self.batch = []
+        self.write_attempts = 0
+        self.retry_at = 0
+
+    def extract(self, status):
+        '''
+        Extract info from tweets
+        '''
+        self.lag = (datetime.datetime.utcnow() - status.created_at).total_seconds()
+        self.sample_rate = sample_rate_for(self.tweet_queue.qsize() + len(self.batch), self.lag)
+        analyse = random.random() < self.sample_rate
+
         # Extract attributes from each tweet
         id_str = status.id_str
         #created_at = aslocaltimestr(status.created_at)
         created_at = status.created_at
-        print(type(status.created_at))
         text = status.text
         if hasattr(status, 'extended_tweet'):
             text = status.extended_tweet['full_text']
@@ -91,44 +238,34 @@ class MyStreamListener(tweepy.StreamListener):
             text = status.retweeted_status.extended_tweet['full_text']
 
         text = deEmojify(text)    # Pre-processing the text
-        #print(text)
-        sentiment = TextBlob(text).sentiment
-        polarity = sentiment.polarity
-        subjectivity = sentiment.subjectivity
+        # Sampled out tweets are only marked by a NULL polarity
+        polarity = None
+        subjectivity = None
+        if analyse:
+            sentiment = TextBlob(text).sentiment
+            polarity = sentiment.polarity
+            subjectivity = sentiment.subjectivity
+        else:
+            self.sampled_out += 1
 
         user_created_at = status.user.created_at
         user_location = deEmojify(status.user.location)
-        user_description = deEmojify(status.user.description)
-        user_followers_count =status.user.followers_count
         longitude = None
         latitude = None
         if status.coordinates:
             longitude = status.coordinates['coordinates'][0]
             latitude = status.coordinates['coordinates'][1]
-
+        user_description = deEmojify(status.user.description)
+        user_followers_count =status.user.followers_count
         retweet_count = status.retweet_count
         favorite_count = status.favorite_count
 
-        print(text)
-        print("Long: {}, Lati: {}".format(longitude, latitude))
-
-        # Store all data in MySQL
-        if conn:
-            mycursor = conn.cursor()
-            sql = "INSERT INTO {} (id_str, created_at, text, polarity, subjectivity, user_created_at, user_location, user_description, user_followers_count, longitude, latitude, retweet_count, favorite_count) VALUES (?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?, ?, ?)".format(TABLE_NAME)
-            val = (id_str, created_at, text, polarity, subjectivity, user_created_at, user_location, \
-                user_description, user_followers_count, longitude, latitude, retweet_count, favorite_count)
-            mycursor.execute(sql, val)
-            conn.commit()
-            mycursor.close()
+        return (id_str, created_at, text, polarity, subjectivity, user_created_at, user_location, \
+            user_description, user_followers_count, longitude, latitude, retweet_count, favorite_count, self.sample_rate)
 
-    def on_error(self, status_code):
-        '''
-        Since Twitter API has rate limits, stop srcraping data as it exceed to the thresold.
-        '''
-        if status_code == 420:
-            # return False to disconnect the stream
-            return False
+    def report(self):
+        print("Written: {}, Sampled out: {}, Dropped: {}, Failed: {}, Queue: {}, Lag: {:.1f}s, Sample rate: {:.2f}".format(
+            self.written, self.sampled_out, self.dropped, self.failed, self.tweet_queue.qsize(), self.lag, self.sample_rate))
 
 
 consumer_key = ""
@@ -140,13 +277,31 @@ access_secret = ""
 #auth.set_access_token(access_key, access_secret)
 #api = tweepy.API(auth)
 
+writer = TweetWriter(queue.Queue(maxsize=QUEUE_MAX_SIZE))
+writer.start()
+
+backoff = BACKOFF_INITIAL_SECONDS
 while True:
+    myStreamListener = MyStreamListener(writer)
     try:
         auth  = tweepy.OAuthHandler(consumer_key, consumer_secret)
         auth.set_access_token(access_key, access_secret)
         api = tweepy.API(auth)
-        myStreamListener = MyStreamListener()
         myStream = tweepy.Stream(auth = api.auth, listener = myStreamListener,tweet_mode='extended')
         myStream.filter(languages=["en"],track=TRACK_WORDS)
-    except:
-        continue
+    except Exception as e:
+        print("Stream error: {}".format(e))
+    # A stream that got connected was healthy, so start backing off afresh
+    if myStreamListener.connected:
+        backoff = BACKOFF_INITIAL_SECONDS
+    if myStreamListener.status_code == 420:
+        backoff = max(backoff, RATE_LIMIT_BACKOFF_SECONDS)
+    if not writer.is_alive():
+        print("Tweet writer died, restarting it with {} queued tweets".format(writer.tweet_queue.qsize()))
+        restarted = TweetWriter(writer.tweet_queue)
+        restarted.dropped = writer.dropped
+        writer = restarted
+        writer.start()
+    print("Stream disconnected, reconnecting in {} seconds".format(backoff))
+    time.sleep(backoff)
+    backoff = min(backoff * 2, BACKOFF_MAX_SECONDS)
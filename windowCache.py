@@ -0,0 +1,231 @@
+import re
+import time
+import datetime
+import threading
+import numpy as np
+import config as c
+
+
+WINDOW_SECONDS = 30*60
+ROW_CAPACITY = 200000
+TOKEN_CAPACITY = 4000000
+MAX_VOCABULARY = 200000
+
+# Polarity class of tweets the streamer sampled out under load
+UNSCORED = 2
+NO_COUNTRY = -1
+
+
+def ring_take(arr, start, stop):
+    '''
+    Values of the ring array between absolute positions start and stop, a view unless it wraps around
+    '''
+    size = len(arr)
+    first = start % size
+    last = first + (stop - start)
+    if last <= size:
+        return arr[first:last]
+    return np.concatenate((arr[first:], arr[:last - size]))
+
+def ring_put(arr, start, values):
+    '''
+    Write values into the ring array from absolute position start onwards
+    '''
+    size = len(arr)
+    first = start % size
+    split = min(len(values), size - first)
+    arr[first:first + split] = values[:split]
+    arr[:len(values) - split] = values[split:]
+
+
+class WindowCache(object):
+    '''
+    The dashboard's last half hour of tweets held as fixed-size NumPy columns in ring buffers.
+
+    Each row is a tweet: its UTC epoch second, polarity class, country index, sentiment weight (1/sample_rate)
+    and the absolute offset of its words and hashtags in the token ring. Words are interned once into
+    `words` so rows only carry int32 token ids. Memory stays bounded by the capacities whatever the traffic.
+    '''
+
+    def __init__(self, window_seconds=WINDOW_SECONDS, capacity=ROW_CAPACITY,
+                 token_capacity=TOKEN_CAPACITY, max_vocabulary=MAX_VOCABULARY):
+        self.window_seconds = window_seconds
+        self.max_vocabulary = max_vocabulary
+        self.created_at = np.zeros(capacity, dtype=np.int64)
+        self.polarity = np.zeros(capacity, dtype=np.int8)
+        self.country = np.full(capacity, NO_COUNTRY, dtype=np.int16)
+        self.weight = np.ones(capacity, dtype=np.float32)
+        self.token_start = np.zeros(capacity, dtype=np.int64)
+        self.tokens = np.zeros(token_capacity, dtype=np.int32)
+        # Rows [tail, head) and tokens [token_start[tail], token_head) are live
+        self.tail = 0
+        self.head = 0
+        self.token_head = 0
+        self.words = []
+        self.word_ids = {}
+        self.is_hashtag = np.zeros(1024, dtype=bool)
+        self.countries = sorted(c.INV_STATE_DICT)
+        self.country_ids = {code: i for i, code in enumerate(self.countries)}
+        self.last_rowid = 0
+        self.backfill_version = None
+        self.lock = threading.Lock()
+
+    def refresh(self, conn):
+        '''
+        Append tweets stored since the last refresh and expire those older than the window
+        '''
+        with self.lock:
+            # Rows already loaded are not read again, so start over once backfill.py has rewritten some
+            backfill_version = self.read_backfill_version(conn)
+            if backfill_version != self.backfill_version:
+                self.backfill_version = backfill_version
+                self.tail = self.head
+                self.last_rowid = 0
+            cutoff = int(time.time()) - self.window_seconds
+            cutoff_str = datetime.datetime.utcfromtimestamp(cutoff).strftime('%Y-%m-%d %H:%M:%S')
+            query = "SELECT rowid, created_at, polarity, user_location, text, sample_rate, country_code, tokens FROM {} WHERE rowid > ? AND created_at >= ? ORDER BY rowid".format(c.TABLE_NAME)
+            rows = conn.execute(query, (self.last_rowid, cutoff_str)).fetchall()
+            if rows:
+                self.last_rowid = rows[-1][0]
+                self.append(rows)
+            self.expire(cutoff)
+
+    def read_backfill_version(self, conn):
+        '''
+        Changes whenever backfill.py checkpoints a chunk, None if it never ran
+        '''
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (c.BACKFILL_TABLE,)).fetchone():
+            return None
+        return conn.execute("SELECT count(*), max(rowid), max(finished_at) FROM {}".format(c.BACKFILL_TABLE)).fetchone()
+
+    def append(self, rows):
+        '''
+        Append (rowid, created_at, polarity, user_location, text, sample_rate, country_code, tokens) rows
+        in arrival order. Country codes and tokens stored by backfill.py are used as they are, an empty
+        country code meaning the location matched nothing.
+        '''
+        rows = rows[-len(self.created_at):]
+        n = len(rows)
+        created_at = np.array([r[1] for r in rows], dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+        # The stream delivers tweets in order, so clamping stragglers to the latest timestamp
+        # only moves them a few seconds and keeps the column sorted for searchsorted
+        last = self.created_at[(self.head - 1) % len(self.created_at)] if self.head > self.tail else created_at[0]
+        created_at = np.maximum.accumulate(np.maximum(created_at, last))
+        polarity = np.array([np.nan if r[2] is None else r[2] for r in rows], dtype=np.float64)
+        # Thresholds are applied here, when tweets are read, so changing them needs no backfill
+        polarity_class = np.where(np.isnan(polarity), UNSCORED, c.polarity_change(np.nan_to_num(polarity))).astype(np.int8)
+        country = np.array([self.country_ids.get(r[6] if r[6] is not None else c.country_code(r[3]), NO_COUNTRY)
+                            for r in rows], dtype=np.int16)
+        weight = 1 / np.array([r[5] or 1 for r in rows], dtype=np.float32)
+
+        token_ids = []
+        lengths = np.zeros(n, dtype=np.int64)
+        for i, r in enumerate(rows):
+            text = r[4] or ''
+            words = r[7].split() if r[7] is not None else c.tokenize(text)
+            ids = [self.intern(w) for w in words]
+            ids += [self.intern(h, hashtag=True) for h in c.hastag(re.sub(r"http\S+", "", text))]
+            lengths[i] = len(ids)
+            token_ids.extend(ids)
+        token_ids = np.array(token_ids, dtype=np.int32)
+        token_start = self.token_head + np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        ring_put(self.created_at, self.head, created_at)
+        ring_put(self.polarity, self.head, polarity_class)
+        ring_put(self.country, self.head, country)
+        ring_put(self.weight, self.head, weight)
+        ring_put(self.token_start, self.head, token_start)
+        overflow = max(0, len(token_ids) - len(self.tokens))
+        ring_put(self.tokens, self.token_head + overflow, token_ids[overflow:])
+        self.head += n
+        self.token_head += len(token_ids)
+
+        # Evict rows overwritten in either ring
+        self.tail = max(self.tail, self.head - len(self.created_at))
+        token_floor = self.token_head - len(self.tokens)
+        self.tail += int(np.searchsorted(self.column(self.token_start), token_floor))
+        if len(self.words) > self.max_vocabulary:
+            self.compact_vocabulary()
+
+    def expire(self, cutoff):
+        self.tail += int(np.searchsorted(self.column(self.created_at), cutoff))
+
+    def intern(self, word, hashtag=False):
+        token_id = self.word_ids.get(word)
+        if token_id is None:
+            token_id = len(self.words)
+            self.words.append(word)
+            self.word_ids[word] = token_id
+            if token_id >= len(self.is_hashtag):
+                self.is_hashtag = np.concatenate((self.is_hashtag, np.zeros(len(self.is_hashtag), dtype=bool)))
+            self.is_hashtag[token_id] = hashtag
+        return token_id
+
+    def compact_vocabulary(self):
+        '''
+        Drop interned words no live row refers to any more and renumber the rest
+        '''
+        start = self.live_token_start()
+        used, inverse = np.unique(ring_take(self.tokens, start, self.token_head), return_inverse=True)
+        ring_put(self.tokens, start, inverse.astype(np.int32))
+        self.words = [self.words[i] for i in used]
+        self.word_ids = {w: i for i, w in enumerate(self.words)}
+        is_hashtag = np.zeros(max(1024, 2 * len(used)), dtype=bool)
+        is_hashtag[:len(used)] = self.is_hashtag[used]
+        self.is_hashtag = is_hashtag
+
+    def column(self, arr):
+        return ring_take(arr, self.tail, self.head)
+
+    def live_token_start(self):
+        if self.head == self.tail:
+            return self.token_head
+        return int(self.token_start[self.tail % len(self.token_start)])
+
+    def count_since(self, since):
+        '''
+        Number of tweets created at or after the given epoch second
+        '''
+        with self.lock:
+            created_at = self.column(self.created_at)
+            return created_at.size - np.searchsorted(created_at, since)
+
+    def sentiment_series(self, bucket_seconds=10):
+        '''
+        Bucket start times and the estimated (negative, neutral, positive) tweet counts per bucket
+        '''
+        # Copy out of the rings, a refresh from the other callback may overwrite them
+        with self.lock:
+            created_at = self.column(self.created_at).copy()
+            polarity = self.column(self.polarity).copy()
+            weight = self.column(self.weight).copy()
+        scored = polarity != UNSCORED
+        if not scored.any():
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+        first = created_at[scored][0] - created_at[scored][0] % bucket_seconds
+        bucket = (created_at[scored] - first) // bucket_seconds
+        nbuckets = int(bucket[-1]) + 1
+        counts = np.bincount(bucket * 3 + polarity[scored] + 1, weights=weight[scored], minlength=nbuckets * 3)
+        return first + np.arange(nbuckets) * bucket_seconds, np.round(counts.reshape(nbuckets, 3))
+
+    def country_counts(self):
+        '''
+        (ISO-3 code, tweets) for every country present in the window, most tweets first
+        '''
+        with self.lock:
+            country = self.column(self.country).copy()
+        # Every tweet keeps its location, only sentiment is sampled, so counts need no weights
+        counts = np.bincount(country[country != NO_COUNTRY], minlength=len(self.countries))
+        order = np.argsort(-counts, kind='stable')
+        return [(self.countries[i], int(counts[i])) for i in order if counts[i] > 0]
+
+    def top_tokens(self, n, hashtags=False):
+        '''
+        The n most frequent words, or hashtags, in the window with their counts
+        '''
+        with self.lock:
+            tokens = ring_take(self.tokens, self.live_token_start(), self.token_head)
+            counts = np.bincount(tokens, minlength=len(self.words))
+            counts[self.is_hashtag[:len(counts)] != hashtags] = 0
+            top = np.argsort(-counts, kind='stable')[:n]
+            return [(self.words[i], int(counts[i])) for i in top if counts[i] > 0]